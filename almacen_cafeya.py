@@ -0,0 +1,219 @@
+import sqlite3
+import os
+import queue
+import threading
+import time
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Cada cafetería tiene su propia base con sus productos y pedidos, así los pedidos de una
+# cafetería no esperan el bloqueo de escritura de otra. Un directorio global guarda los
+# usuarios y a qué cafetería pertenece cada producto.
+DIRECTORIO_DB = 'cafeya_directorio.db'
+CARPETA_CAFETERIAS = 'cafeterias'
+TAMANO_POOL = 4 # Conexiones libres que se guardan por base
+HILOS_CONSULTA = 8 # Hilos para consultar varias cafeterías en paralelo
+BITS_CAFETERIA = 20 # Bits bajos del id de pedido que guardan el id de la cafetería (ver nuevo_id_pedido)
+EPOCA_PEDIDOS_MS = 1577836800000 # 2020-01-01 UTC, en milisegundos
+
+_pools = {} # ruta de la base -> cola de conexiones libres
+_pools_lock = threading.Lock()
+_cafeteria_de_producto = {} # producto_id -> cafeteria_id (un producto nunca cambia de cafetería)
+_ejecutor = ThreadPoolExecutor(max_workers=HILOS_CONSULTA) # Solo para consultas de las rutas, no para tareas de fondo
+log = logging.getLogger(__name__)
+
+# --------------------------- Esquemas -------------------------------
+def crear_directorio(conn):
+    cursor = conn.cursor()
+
+    # Tabla usuarios: id, nombre, tipo (cliente/cafeteria)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL UNIQUE, -- Añadido UNIQUE para nombres de usuario
+        tipo TEXT NOT NULL
+    )''')
+
+    # Tabla productos_directorio: reparte ids de producto únicos entre cafeterías y sabe a cuál pertenece cada uno
+    cursor.execute('''CREATE TABLE IF NOT EXISTS productos_directorio (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cafeteria_id INTEGER NOT NULL,
+        FOREIGN KEY (cafeteria_id) REFERENCES usuarios(id)
+    )''')
+
+def crear_base_cafeteria(conn):
+    cursor = conn.cursor()
+
+    # Tabla productos: el id viene de productos_directorio
+    cursor.execute('''CREATE TABLE IF NOT EXISTS productos (
+        id INTEGER PRIMARY KEY,
+        nombre TEXT NOT NULL,
+        precio REAL NOT NULL,
+        stock INTEGER NOT NULL,
+        horario_retiro TEXT,
+        cafeteria_id INTEGER NOT NULL,
+        categoria TEXT
+    )''')
+
+    # Tabla pedidos: el id lo da nuevo_id_pedido, así es único entre todas las cafeterías
+    cursor.execute('''CREATE TABLE IF NOT EXISTS pedidos (
+        id INTEGER PRIMARY KEY,
+        usuario_id INTEGER NOT NULL,
+        producto_id INTEGER NOT NULL,
+        estado TEXT NOT NULL DEFAULT 'pendiente', -- Estado por defecto
+        horario_retiro TEXT,
+        cantidad_pedida INTEGER NOT NULL,
+        precio_unitario_al_comprar REAL NOT NULL, -- Para registrar el precio exacto de compra
+        creado_en TEXT DEFAULT CURRENT_TIMESTAMP, -- Fecha de creación, usada para archivar pedidos viejos
+        FOREIGN KEY (producto_id) REFERENCES productos(id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_creado_en ON pedidos (creado_en)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_usuario ON pedidos (usuario_id)")
+
+    # Tabla archivos_pedidos: un archivo de pedidos viejos por mes (ver archivar_pedidos)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS archivos_pedidos (
+        mes TEXT PRIMARY KEY, -- Formato AAAA_MM
+        archivo TEXT NOT NULL
+    )''')
+
+    # Tabla claves_idempotencia: clave enviada por el cliente (Idempotency-Key) y la respuesta que se le dio,
+    # para que un pedido reenviado no se registre dos veces
+    cursor.execute('''CREATE TABLE IF NOT EXISTS claves_idempotencia (
+        clave TEXT PRIMARY KEY, -- Índice único: una misma clave no puede registrar dos pedidos
+        usuario_id INTEGER NOT NULL,
+        pedido_id INTEGER NOT NULL,
+        respuesta TEXT NOT NULL, -- JSON devuelto al crear el pedido
+        creado_en REAL NOT NULL,
+        huella TEXT, -- Hash de los datos del pedido: la misma clave con otros datos se rechaza
+        FOREIGN KEY (pedido_id) REFERENCES pedidos(id)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_claves_creado_en ON claves_idempotencia (creado_en)")
+    # Bases creadas antes de agregar huella: las claves que ya estaban quedan sin huella y no se comparan
+    cursor.execute("PRAGMA table_info(claves_idempotencia)")
+    if 'huella' not in [columna[1] for columna in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE claves_idempotencia ADD COLUMN huella TEXT")
+
+def ruta_cafeteria(cafeteria_id):
+    return os.path.join(CARPETA_CAFETERIAS, f"cafeteria_{cafeteria_id}.db")
+
+def crear_cafeteria(cafeteria_id):
+    """Crea (si no existe) la base propia de una cafetería."""
+    if cafeteria_id >= 1 << BITS_CAFETERIA:
+        raise ValueError(f"El id de cafetería {cafeteria_id} no entra en los {BITS_CAFETERIA} bits reservados en los ids de pedido")
+    os.makedirs(CARPETA_CAFETERIAS, exist_ok=True)
+    conn = sqlite3.connect(ruta_cafeteria(cafeteria_id))
+    crear_base_cafeteria(conn)
+    conn.commit()
+    conn.close()
+
+def crear_base_datos():
+    """Crea el directorio global y la base de cada cafetería registrada."""
+    conn = sqlite3.connect(DIRECTORIO_DB)
+    crear_directorio(conn)
+    conn.commit()
+    cafeterias = [fila[0] for fila in conn.execute("SELECT id FROM usuarios WHERE tipo = 'cafeteria'")]
+    conn.close()
+
+    for cafeteria_id in cafeterias:
+        crear_cafeteria(cafeteria_id)
+
+# ------------------------ Pool de conexiones ------------------------
+def _uri(ruta):
+    # mode=rw: si la base no existe se lanza un error en lugar de crear una base vacía sin tablas
+    return Path(ruta).resolve().as_uri() + '?mode=rw'
+
+def _nueva_conexion(ruta, con_directorio):
+    conn = sqlite3.connect(_uri(ruta), timeout=10, check_same_thread=False, uri=True)
+    if con_directorio:
+        # Permite unir pedidos con directorio.usuarios para mostrar nombres
+        conn.execute("ATTACH DATABASE ? AS directorio", (_uri(DIRECTORIO_DB),))
+    return conn
+
+@contextmanager
+def _conexion(ruta, con_directorio=False):
+    """Presta una conexión del pool de la base indicada y la devuelve al terminar."""
+    with _pools_lock:
+        libres = _pools.setdefault(ruta, queue.LifoQueue(maxsize=TAMANO_POOL))
+    try:
+        conn = libres.get_nowait()
+    except queue.Empty:
+        conn = None
+    if conn is None:
+        conn = _nueva_conexion(ruta, con_directorio) # Fuera del except, así sus errores no arrastran el queue.Empty
+
+    try:
+        yield conn
+    except Exception:
+        conn.close() # Ante un error no se reutiliza la conexión
+        raise
+
+    if conn.in_transaction:
+        conn.rollback() # Nunca se devuelve al pool una transacción abierta
+    try:
+        libres.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def conexion_directorio():
+    return _conexion(DIRECTORIO_DB)
+
+def conexion_cafeteria(cafeteria_id):
+    return _conexion(ruta_cafeteria(cafeteria_id), con_directorio=True)
+
+# ----------------------------- Ruteo --------------------------------
+def es_cafeteria(usuario_id):
+    """Indica si el usuario existe y es de tipo 'cafeteria'."""
+    with conexion_directorio() as conn:
+        fila = conn.execute("SELECT tipo FROM usuarios WHERE id = ?", (usuario_id,)).fetchone()
+    return bool(fila) and fila[0] == 'cafeteria'
+
+def ids_cafeterias():
+    with conexion_directorio() as conn:
+        return [fila[0] for fila in conn.execute("SELECT id FROM usuarios WHERE tipo = 'cafeteria' ORDER BY id")]
+
+def registrar_producto(cafeteria_id):
+    """Reserva un id de producto global para la cafetería y lo devuelve."""
+    with conexion_directorio() as conn:
+        producto_id = conn.execute("INSERT INTO productos_directorio (cafeteria_id) VALUES (?)", (cafeteria_id,)).lastrowid
+        conn.commit()
+    _cafeteria_de_producto[producto_id] = cafeteria_id
+    return producto_id
+
+def nuevo_id_pedido(conn, cafeteria_id):
+    """Da el id del próximo pedido de la cafetería sin escribir en el directorio.
+
+    El id es (milisegundos desde 2020 << BITS_CAFETERIA) | cafeteria_id. Los bits bajos dicen de qué
+    cafetería es el pedido, así dos cafeterías nunca dan el mismo id; los altos siguen al reloj, así
+    ordenar por id también ordena por antigüedad entre cafeterías. Si el reloj no avanzó desde el último
+    pedido de la base se usa el lugar siguiente. Hay que llamarla dentro de la transacción que inserta
+    el pedido, con el bloqueo de escritura de la cafetería ya tomado.
+    """
+    ultimo = conn.execute("SELECT MAX(id) FROM main.pedidos").fetchone()[0] or 0
+    tiempo = max(int(time.time() * 1000) - EPOCA_PEDIDOS_MS, (ultimo >> BITS_CAFETERIA) + 1)
+    return (tiempo << BITS_CAFETERIA) | cafeteria_id
+
+def cafeteria_de_producto(producto_id):
+    """Devuelve la cafetería dueña del producto, o None si el producto no existe."""
+    if producto_id not in _cafeteria_de_producto:
+        with conexion_directorio() as conn:
+            fila = conn.execute("SELECT cafeteria_id FROM productos_directorio WHERE id = ?", (producto_id,)).fetchone()
+        if not fila:
+            return None
+        _cafeteria_de_producto[producto_id] = fila[0]
+    return _cafeteria_de_producto[producto_id]
+
+def en_cada_cafeteria(funcion):
+    """Ejecuta funcion(cafeteria_id) en paralelo para todas las cafeterías y devuelve los resultados en orden.
+
+    Si la base de una cafetería falla, se registra el error y se omite su resultado: una cafetería
+    caída no deja sin respuesta a las demás.
+    """
+    def en_cafeteria(cafeteria_id):
+        try:
+            return [funcion(cafeteria_id)]
+        except sqlite3.Error:
+            log.exception("Falló la consulta a la cafetería %s", cafeteria_id)
+            return []
+
+    return [resultado for resultados in _ejecutor.map(en_cafeteria, ids_cafeterias()) for resultado in resultados]
@@ -4,51 +4,355 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import requests
 import os # Importamos os para gestionar la eliminación de archivos de gráficos
+import json
+import threading
+import time
+import heapq
+import hashlib
+from collections import OrderedDict
+from itertools import chain, islice
+from datetime import datetime, timedelta, timezone
+from almacen_cafeya import (DIRECTORIO_DB, crear_base_datos, crear_cafeteria, conexion_directorio, conexion_cafeteria,
+                            es_cafeteria, ids_cafeterias, registrar_producto, nuevo_id_pedido, cafeteria_de_producto,
+                            en_cada_cafeteria)
+from migrar_cafeya import migrar
+
+try:
+    import orjson # Serializador rápido (opcional); si no está instalado usamos json de la librería estándar
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
 # --------------------- Inicializar Base de Datos ---------------------
-def crear_base_datos():
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-
-    # Tabla usuarios: id, nombre, tipo (cliente/cafeteria)
-    cursor.execute('''CREATE TABLE IF NOT EXISTS usuarios (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT NOT NULL UNIQUE, -- Añadido UNIQUE para nombres de usuario
-        tipo TEXT NOT NULL
-    )''')
-
-    # Tabla productos: id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria
-    cursor.execute('''CREATE TABLE IF NOT EXISTS productos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT NOT NULL,
-        precio REAL NOT NULL,
-        stock INTEGER NOT NULL,
-        horario_retiro TEXT,
-        cafeteria_id INTEGER NOT NULL,
-        categoria TEXT,
-        FOREIGN KEY (cafeteria_id) REFERENCES usuarios(id)
-    )''')
-
-    # Tabla pedidos: id, usuario_id (cliente), producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar
-    cursor.execute('''CREATE TABLE IF NOT EXISTS pedidos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        usuario_id INTEGER NOT NULL,
-        producto_id INTEGER NOT NULL,
-        estado TEXT NOT NULL DEFAULT 'pendiente', -- Estado por defecto
-        horario_retiro TEXT,
-        cantidad_pedida INTEGER NOT NULL,
-        precio_unitario_al_comprar REAL NOT NULL, -- Para registrar el precio exacto de compra
-        FOREIGN KEY (usuario_id) REFERENCES usuarios(id),
-        FOREIGN KEY (producto_id) REFERENCES productos(id)
-    )''')
-
-    conn.commit()
-    conn.close()
-
+# Un directorio global (usuarios) y una base por cafetería (productos y pedidos), ver almacen_cafeya
+if not os.path.exists(DIRECTORIO_DB) and os.path.exists('cafeya.db'):
+    # Primera ejecución después del cambio: se migra la base única anterior. Si la migración no
+    # puede terminar no se arranca, para no crear un directorio vacío al lado de los datos viejos
+    if not migrar():
+        raise SystemExit("No se pudo migrar cafeya.db. Revise los mensajes anteriores.")
 crear_base_datos()
 
+# ------------------- Serialización de respuestas --------------------
+TAMANO_LOTE = 500 # Filas que se leen del cursor por vez
+
+def a_json(obj):
+    """Serializa a bytes JSON usando orjson si está disponible."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def lotes_cursor(cursor, tamano=TAMANO_LOTE):
+    """Recorre el cursor en lotes de filas en lugar de hacer fetchall()."""
+    return iter(lambda: cursor.fetchmany(tamano), [])
+
+def serializar_filas(lotes, claves, compacto=False):
+    """Convierte lotes de tuplas en bytes JSON sin armar la lista completa de dicts.
+
+    Formato normal: [{clave: valor, ...}, ...]
+    Formato compacto: {"columnas": [...], "filas": [[...], ...]}
+    Devuelve (cuerpo, cantidad_de_filas).
+
+    Las filas se leen del cursor de a un lote, pero el cuerpo se arma completo en memoria antes de
+    responder: respuesta_json necesita el cuerpo entero para calcular el ETag que usa la caché del cliente.
+    """
+    partes = []
+    cantidad = 0
+    for lote in lotes:
+        if not lote:
+            continue
+        cantidad += len(lote)
+        if compacto:
+            # Las tuplas se serializan directamente como arreglos
+            partes.append(a_json(lote)[1:-1])
+        else:
+            partes.append(a_json([dict(zip(claves, fila)) for fila in lote])[1:-1])
+
+    filas = b'[' + b','.join(partes) + b']'
+    if compacto:
+        return b'{"columnas":' + a_json(list(claves)) + b',"filas":' + filas + b'}', cantidad
+    return filas, cantidad
+
+def unir_por_id(resultados, tamano=TAMANO_LOTE):
+    """Une los lotes de varias cafeterías, cada una ordenada por id descendente, en lotes ordenados por id descendente.
+
+    El id de la fila tiene que ser la primera columna.
+    """
+    filas = heapq.merge(*(chain.from_iterable(lotes) for lotes in resultados), key=lambda fila: fila[0], reverse=True)
+    return iter(lambda: list(islice(filas, tamano)), [])
+
+def formato_compacto():
+    """El cliente puede pedir el formato columnas + filas con ?formato=compacto."""
+    return request.args.get('formato') == 'compacto'
+
+def respuesta_json(cuerpo, codigo=200):
+    """Arma la respuesta con ETag para que el cliente pueda revalidar su caché (304 si no cambió).
+
+    El ETag es un hash del cuerpo completo, por eso la respuesta no se envía en streaming.
+    """
+    respuesta = app.response_class(cuerpo, status=codigo, mimetype='application/json')
+    respuesta.add_etag()
+    return respuesta.make_conditional(request)
+
+# ------------------- Idempotencia de pedidos ------------------------
+TTL_CLAVES = 24 * 60 * 60 # Segundos que se conserva una clave de idempotencia
+MAX_CLAVES_MEMORIA = 1024 # Claves recientes que se mantienen en memoria (LRU)
+INTERVALO_BARRIDO = 10 * 60 # Cada cuántos segundos se borran las claves vencidas
+
+_claves_recientes = OrderedDict() # clave -> (usuario_id, huella, respuesta, creado_en), igual que la fila de la base
+_claves_lock = threading.Lock()
+
+def huella_pedido(usuario_id, producto_id, horario_retiro, cantidad, cafeteria_id):
+    """Hash de los datos del pedido, para saber si un reintento con la misma clave pide lo mismo."""
+    datos = [usuario_id, producto_id, horario_retiro, cantidad, cafeteria_id]
+    return hashlib.sha256(a_json(datos)).hexdigest()
+
+def recordar_clave(clave, usuario_id, huella, respuesta, creado_en):
+    """Guarda la clave en la LRU en memoria, descartando la menos usada si se llena."""
+    with _claves_lock:
+        _claves_recientes[clave] = (usuario_id, huella, respuesta, creado_en)
+        _claves_recientes.move_to_end(clave)
+        while len(_claves_recientes) > MAX_CLAVES_MEMORIA:
+            _claves_recientes.popitem(last=False)
+
+def buscar_clave(cursor, clave, cafeteria_id):
+    """Busca la clave: primero en memoria, después en la base de la cafetería del pedido y por último en las demás.
+
+    La clave se guarda en la base de la cafetería donde se registró el pedido. Si se reusa para un producto
+    de otra cafetería, se la encuentra igual en la base de la primera, así el resultado no depende de que
+    la clave siga o no en memoria. Esa búsqueda en las demás cafeterías solo ocurre con claves nuevas.
+    Una clave vencida (más vieja que TTL_CLAVES) se descarta aunque el barrido todavía no la haya borrado.
+    Devuelve (usuario_id, huella, respuesta, creado_en) o None.
+    """
+    limite = time.time() - TTL_CLAVES
+    with _claves_lock:
+        previa = _claves_recientes.get(clave)
+        if previa and previa[3] >= limite:
+            _claves_recientes.move_to_end(clave)
+            return previa
+        _claves_recientes.pop(clave, None)
+
+    consulta = "SELECT usuario_id, huella, respuesta, creado_en FROM claves_idempotencia WHERE clave = ?"
+    cursor.execute(consulta, (clave,))
+    previa = cursor.fetchone()
+    if previa and previa[3] < limite:
+        # Se borra dentro de la transacción del pedido, así la clave puede volver a registrarse
+        cursor.execute("DELETE FROM claves_idempotencia WHERE clave = ?", (clave,))
+        previa = None
+
+    if not previa:
+        def en_otra(otra_id):
+            if otra_id == cafeteria_id:
+                return None
+            with conexion_cafeteria(otra_id) as conn:
+                return conn.execute(consulta, (clave,)).fetchone()
+        previa = next((fila for fila in en_cada_cafeteria(en_otra) if fila and fila[3] >= limite), None)
+
+    if previa:
+        recordar_clave(clave, *previa)
+    return previa
+
+def respuesta_pedido(cuerpo, repetida=False):
+    """Respuesta 201 de un pedido. Los reintentos reciben exactamente los mismos bytes que la primera vez."""
+    respuesta = app.response_class(cuerpo, status=201, mimetype='application/json')
+    if repetida:
+        respuesta.headers['Idempotent-Replayed'] = 'true'
+    return respuesta
+
+def respuesta_repetida(previa, usuario_id, huella):
+    """Devuelve la misma respuesta que se dio la primera vez que llegó la clave, si el pedido es el mismo."""
+    usuario_previo, huella_previa, respuesta, _ = previa
+    if usuario_previo != usuario_id:
+        return jsonify({"error": "La clave de idempotencia ya fue usada por otro usuario"}), 422
+    if huella_previa is not None and huella_previa != huella:
+        return jsonify({"error": "La clave de idempotencia ya fue usada para un pedido con otros datos"}), 422
+    return respuesta_pedido(respuesta, repetida=True)
+
+def barrer_claves_vencidas():
+    """Elimina de la base y de la memoria las claves más viejas que TTL_CLAVES."""
+    limite = time.time() - TTL_CLAVES
+
+    # Una cafetería por vez y en este hilo: los hilos de en_cada_cafeteria quedan para las rutas
+    for cafeteria_id in ids_cafeterias():
+        try:
+            with conexion_cafeteria(cafeteria_id) as conn:
+                conn.execute("DELETE FROM claves_idempotencia WHERE creado_en < ?", (limite,))
+                conn.commit()
+        except sqlite3.Error:
+            pass # Base ocupada: se reintenta en el próximo ciclo
+
+    with _claves_lock:
+        for clave in [c for c, (_, _, _, creado_en) in _claves_recientes.items() if creado_en < limite]:
+            del _claves_recientes[clave]
+
+def iniciar_barrido_claves():
+    """Lanza un hilo en segundo plano que barre las claves vencidas periódicamente."""
+    def ciclo():
+        while True:
+            time.sleep(INTERVALO_BARRIDO)
+            try:
+                barrer_claves_vencidas()
+            except sqlite3.Error:
+                pass # Base ocupada: se reintenta en el próximo ciclo
+
+    threading.Thread(target=ciclo, daemon=True).start()
+
+iniciar_barrido_claves()
+
+# ---------------------- Archivado de pedidos ------------------------
+DIAS_ARCHIVO = int(os.environ.get('CAFEYA_DIAS_ARCHIVO', 90)) # Antigüedad a partir de la cual se archiva un pedido cerrado
+CARPETA_ARCHIVO = 'archivo_pedidos'
+LOTE_ARCHIVO = 500 # Pedidos movidos por transacción, para no bloquear a quienes escriben
+INTERVALO_ARCHIVO = 60 * 60 # Cada cuántos segundos corre el archivado en segundo plano
+COLUMNAS_PEDIDOS = 'id, usuario_id, producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar, creado_en'
+
+def ruta_archivo(cafeteria_id, mes):
+    return os.path.join(CARPETA_ARCHIVO, f"cafeteria_{cafeteria_id}", f"pedidos_{mes}.db")
+
+def mover_a_archivo(conn, cafeteria_id, mes, ids):
+    """Mueve los pedidos indicados a la base de archivo de su mes, en una sola transacción."""
+    archivo = ruta_archivo(cafeteria_id, mes)
+    conn.execute("ATTACH DATABASE ? AS archivo", (archivo,))
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS archivo.pedidos (
+            id INTEGER PRIMARY KEY, -- Se conserva el id original
+            usuario_id INTEGER NOT NULL,
+            producto_id INTEGER NOT NULL,
+            estado TEXT NOT NULL,
+            horario_retiro TEXT,
+            cantidad_pedida INTEGER NOT NULL,
+            precio_unitario_al_comprar REAL NOT NULL,
+            creado_en TEXT
+        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS archivo.idx_pedidos_usuario ON pedidos (usuario_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS archivo.idx_pedidos_producto ON pedidos (producto_id)")
+
+        marcas = ', '.join('?' * len(ids))
+        conn.execute(f"INSERT OR IGNORE INTO archivo.pedidos ({COLUMNAS_PEDIDOS}) SELECT {COLUMNAS_PEDIDOS} FROM main.pedidos WHERE id IN ({marcas})", ids)
+        conn.execute(f"DELETE FROM main.pedidos WHERE id IN ({marcas})", ids)
+        conn.execute("INSERT OR IGNORE INTO main.archivos_pedidos (mes, archivo) VALUES (?, ?)", (mes, archivo))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE archivo")
+
+def archivar_cafeteria(cafeteria_id, dias=DIAS_ARCHIVO, lote=LOTE_ARCHIVO):
+    """Mueve los pedidos completados o cancelados con más de `dias` días fuera de la tabla pedidos de una cafetería.
+
+    Cada lote se confirma por separado, así el bloqueo de escritura dura poco.
+    Devuelve la cantidad de pedidos archivados.
+    """
+    os.makedirs(os.path.join(CARPETA_ARCHIVO, f"cafeteria_{cafeteria_id}"), exist_ok=True)
+    movidos = 0
+    with conexion_cafeteria(cafeteria_id) as conn:
+        while True:
+            cursor = conn.execute('''
+                SELECT id, strftime('%Y_%m', creado_en)
+                FROM pedidos
+                WHERE estado IN ('completado', 'cancelado') AND creado_en < datetime('now', ?)
+                ORDER BY id
+                LIMIT ?''', (f'-{dias} days', lote))
+            filas = cursor.fetchall()
+            if not filas:
+                break
+
+            por_mes = {}
+            for pedido_id, mes in filas:
+                por_mes.setdefault(mes, []).append(pedido_id)
+            for mes, ids in por_mes.items():
+                mover_a_archivo(conn, cafeteria_id, mes, ids)
+            movidos += len(filas)
+    return movidos
+
+def archivar_pedidos(dias=DIAS_ARCHIVO, lote=LOTE_ARCHIVO):
+    """Archiva los pedidos viejos de todas las cafeterías, una por vez y en el hilo que la llama.
+
+    No usa los hilos de en_cada_cafeteria, que quedan libres para las rutas. Si una cafetería
+    falla se sigue con las demás.
+    """
+    movidos = 0
+    for cafeteria_id in ids_cafeterias():
+        try:
+            movidos += archivar_cafeteria(cafeteria_id, dias, lote)
+        except sqlite3.Error:
+            pass # Base ocupada: se reintenta en el próximo ciclo
+    return movidos
+
+def iniciar_archivado():
+    """Lanza un hilo en segundo plano que archiva pedidos viejos periódicamente."""
+    def ciclo():
+        while True:
+            time.sleep(INTERVALO_ARCHIVO)
+            try:
+                archivar_pedidos()
+            except sqlite3.Error:
+                pass # Base ocupada: se reintenta en el próximo ciclo
+
+    threading.Thread(target=ciclo, daemon=True).start()
+
+iniciar_archivado()
+
+def rango_historial(completo_por_defecto=False):
+    """Lee ?desde=AAAA-MM-DD y ?historial=completo|reciente. Devuelve (desde, con_archivo).
+
+    Sin desde ni historial, los listados (completo_por_defecto=False) leen solo la tabla pedidos: los
+    pedidos de los últimos DIAS_ARCHIVO días y todos los pendientes. Las exportaciones (CSV y gráfico,
+    completo_por_defecto=True) leen todo el historial, incluidos los archivos mensuales. Un desde que
+    llega hasta pedidos ya archivados también lee los archivos. Lanza ValueError si desde no es una
+    fecha válida o historial no es 'completo' ni 'reciente'.
+    """
+    historial = request.args.get('historial')
+    if historial not in (None, 'completo', 'reciente'):
+        raise ValueError("El parámetro 'historial' debe ser 'completo' o 'reciente'")
+    desde = request.args.get('desde')
+    if desde:
+        try:
+            fecha = datetime.strptime(desde, '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError("El parámetro 'desde' debe ser una fecha con formato AAAA-MM-DD")
+        # creado_en se guarda en UTC (datetime('now')), igual que la fecha de corte del archivado
+        corte = datetime.now(timezone.utc).date() - timedelta(days=DIAS_ARCHIVO)
+        return fecha.isoformat(), fecha <= corte
+    if historial is None:
+        return None, completo_por_defecto
+    return None, historial == 'completo'
+
+def lotes_pedidos(conn, consulta, parametros, desde=None, con_archivo=False, por_id=True):
+    """Ejecuta la consulta sobre la tabla pedidos y, si se pide, sobre los archivos mensuales.
+
+    La consulta usa {pedidos} en lugar del nombre de la tabla. Si se indica `desde`, se omiten los
+    archivos de meses anteriores. Con archivos, las filas de la tabla activa y de cada archivo se
+    intercalan por id descendente (la primera columna): un pedido pendiente viejo sigue en la tabla
+    activa y no debe salir antes que uno archivado más nuevo. Cada archivo se lee completo antes de
+    desconectarlo; la tabla activa se sigue leyendo por lotes. Con por_id=False (consultas agrupadas,
+    sin id) las filas se devuelven una tanda detrás de otra.
+    """
+    if not con_archivo:
+        yield from lotes_cursor(conn.execute(consulta.format(pedidos='main.pedidos'), parametros))
+        return
+
+    mes_desde = desde[:7].replace('-', '_') if desde else ''
+    archivos = conn.execute("SELECT archivo FROM archivos_pedidos WHERE mes >= ? ORDER BY mes DESC", (mes_desde,)).fetchall()
+    archivados = []
+    for (archivo,) in archivos:
+        if not os.path.exists(archivo):
+            continue
+        conn.execute("ATTACH DATABASE ? AS archivo", (archivo,))
+        try:
+            cursor = conn.execute(consulta.format(pedidos='archivo.pedidos'), parametros)
+            archivados.append(list(lotes_cursor(cursor)))
+            cursor.close()
+        finally:
+            conn.execute("DETACH DATABASE archivo")
+
+    activos = lotes_cursor(conn.execute(consulta.format(pedidos='main.pedidos'), parametros))
+    if por_id:
+        yield from unir_por_id([activos, *archivados])
+    else:
+        yield from chain(activos, *archivados)
+
 # ------------------------- Rutas de la API --------------------------
 
 @app.route('/')
@@ -66,19 +370,19 @@ def registrar_usuario():
     if tipo not in ['cliente', 'cafeteria']:
         return jsonify({"error": "Tipo de usuario inválido. Debe ser 'cliente' o 'cafeteria'"}), 400
 
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO usuarios (nombre, tipo) VALUES (?, ?)", (nombre, tipo))
-        conn.commit()
-        id_nuevo = cursor.lastrowid
+        with conexion_directorio() as conn:
+            id_nuevo = conn.execute("INSERT INTO usuarios (nombre, tipo) VALUES (?, ?)", (nombre, tipo)).lastrowid
+            if tipo == 'cafeteria':
+                # Cada cafetería tiene su propia base de productos y pedidos. Se crea antes de confirmar
+                # el usuario: si falla, la cafetería no queda registrada sin base
+                crear_cafeteria(id_nuevo)
+            conn.commit()
         return jsonify({"mensaje": "Usuario registrado", "usuario_id": id_nuevo}), 200
     except sqlite3.IntegrityError:
         return jsonify({"error": "El nombre de usuario ya existe"}), 409 # Conflict
     except Exception as e:
         return jsonify({"error": f"Error al registrar usuario: {str(e)}"}), 500
-    finally:
-        conn.close()
 
 
 @app.route('/login_usuario', methods=['POST'])
@@ -89,11 +393,8 @@ def login_usuario():
     if not nombre:
         return jsonify({"error": "El nombre es requerido para iniciar sesión"}), 400
 
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, tipo FROM usuarios WHERE nombre = ?", (nombre,))
-    user = cursor.fetchone()
-    conn.close()
+    with conexion_directorio() as conn:
+        user = conn.execute("SELECT id, tipo FROM usuarios WHERE nombre = ?", (nombre,)).fetchone()
 
     if user:
         return jsonify({"mensaje": "Login exitoso", "usuario_id": user[0], "tipo": user[1]}), 200
@@ -117,41 +418,37 @@ def cargar_producto():
     if not isinstance(stock, int) or stock < 0:
         return jsonify({"error": "El stock debe ser un número entero no negativo"}), 400
 
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
     try:
         # Verificar que el cafeteria_id existe y es de tipo 'cafeteria'
-        cursor.execute("SELECT tipo FROM usuarios WHERE id = ?", (cafeteria_id,))
-        user_type = cursor.fetchone()
-        if not user_type or user_type[0] != 'cafeteria':
+        if not es_cafeteria(cafeteria_id):
             return jsonify({"error": "Solo las cafeterías pueden cargar productos o el ID de cafetería no es válido"}), 403 # Forbidden
 
-        cursor.execute("""
-            INSERT INTO productos (nombre, precio, stock, horario_retiro, cafeteria_id, categoria)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            (nombre, precio, stock, horario_retiro, cafeteria_id, categoria))
-        conn.commit()
+        # El id del producto se reserva en el directorio y el producto se guarda en la base de la cafetería
+        producto_id = registrar_producto(cafeteria_id)
+        with conexion_cafeteria(cafeteria_id) as conn:
+            conn.execute("""
+                INSERT INTO productos (id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (producto_id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria))
+            conn.commit()
         return jsonify({"mensaje": "Producto cargado", "categoria": categoria}), 201 # Created
     except Exception as e:
         return jsonify({"error": f"Error al cargar producto: {str(e)}"}), 500
-    finally:
-        conn.close()
 
 @app.route('/productos', methods=['GET'])
 def listar_productos():
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria FROM productos WHERE stock > 0") # Solo productos con stock > 0
-    productos = cursor.fetchall()
-    conn.close()
+    def productos_de(cafeteria_id):
+        with conexion_cafeteria(cafeteria_id) as conn:
+            cursor = conn.execute("SELECT id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria FROM productos WHERE stock > 0") # Solo productos con stock > 0
+            return list(lotes_cursor(cursor))
 
-    if not productos:
-        return jsonify([]), 200 # Devolver una lista vacía si no hay productos con stock
+    # Se consulta cada cafetería en paralelo; sus lotes se serializan uno detrás de otro
+    cuerpo, _ = serializar_filas(chain.from_iterable(en_cada_cafeteria(productos_de)),
+                                 ('id', 'nombre', 'precio', 'stock', 'horario_retiro', 'cafeteria_id', 'categoria'),
+                                 formato_compacto())
 
-    return jsonify([{
-        'id': p[0], 'nombre': p[1], 'precio': p[2], 'stock': p[3],
-        'horario_retiro': p[4], 'cafeteria_id': p[5], 'categoria': p[6]
-    } for p in productos]), 200
+    # Si no hay productos con stock se devuelve una lista vacía
+    return respuesta_json(cuerpo)
 
 @app.route('/pedido', methods=['POST'])
 def hacer_pedido():
@@ -160,48 +457,87 @@ def hacer_pedido():
     producto_id = data.get('producto_id')
     horario_retiro = data.get('horario_retiro')
     cantidad = data.get('cantidad', 1) # Añadimos cantidad, por defecto 1
+    clave = request.headers.get('Idempotency-Key') # Opcional: permite reintentar sin duplicar el pedido
 
     if not all([usuario_id, producto_id, horario_retiro, cantidad is not None]):
         return jsonify({"error": "Datos incompletos para el pedido"}), 400
     if not isinstance(cantidad, int) or cantidad <= 0:
         return jsonify({"error": "La cantidad debe ser un número entero positivo"}), 400
-
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-    try:
-        # 1. Verificar si el producto existe y tiene stock suficiente
-        cursor.execute("SELECT nombre, stock, precio FROM productos WHERE id = ?", (producto_id,))
-        producto = cursor.fetchone()
-        if not producto:
-            return jsonify({"error": "Producto no encontrado"}), 404
-        
-        nombre_producto, stock_actual, precio_unitario = producto
-
-        if stock_actual < cantidad:
-            return jsonify({"error": f"Stock insuficiente para {nombre_producto}. Stock disponible: {stock_actual}"}), 400
-
-        # 2. Reducir el stock del producto
-        nuevo_stock = stock_actual - cantidad
-        cursor.execute("UPDATE productos SET stock = ? WHERE id = ?", (nuevo_stock, producto_id))
-
-        # 3. Registrar el pedido
-        cursor.execute("INSERT INTO pedidos (usuario_id, producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar) VALUES (?, ?, ?, ?, ?, ?)",
-                       (usuario_id, producto_id, 'pendiente', horario_retiro, cantidad, precio_unitario))
-        
-        conn.commit()
-        return jsonify({"mensaje": "Pedido registrado y stock actualizado"}), 201 # Created
-    except Exception as e:
-        conn.rollback() # Revertir cualquier cambio si hay un error
-        return jsonify({"error": f"Error al hacer el pedido: {str(e)}"}), 500
-    finally:
-        conn.close()
+    if not isinstance(producto_id, int):
+        return jsonify({"error": "El ID del producto debe ser un número entero"}), 400
+
+    # El pedido se registra en la base de la cafetería dueña del producto
+    cafeteria_id = cafeteria_de_producto(producto_id)
+    if cafeteria_id is None:
+        return jsonify({"error": "Producto no encontrado"}), 404
+
+    huella = huella_pedido(usuario_id, producto_id, horario_retiro, cantidad, cafeteria_id) if clave else None
+
+    with conexion_cafeteria(cafeteria_id) as conn:
+        cursor = conn.cursor()
+        try:
+            # 0. Si la clave ya se usó, es un reintento: se devuelve la respuesta original
+            if clave:
+                previa = buscar_clave(cursor, clave, cafeteria_id)
+                if previa:
+                    return respuesta_repetida(previa, usuario_id, huella)
+
+            # 1. Verificar si el producto existe y tiene stock suficiente
+            cursor.execute("SELECT nombre, stock, precio FROM productos WHERE id = ?", (producto_id,))
+            producto = cursor.fetchone()
+            if not producto:
+                return jsonify({"error": "Producto no encontrado"}), 404
+
+            nombre_producto, stock_actual, precio_unitario = producto
+
+            if stock_actual < cantidad:
+                return jsonify({"error": f"Stock insuficiente para {nombre_producto}. Stock disponible: {stock_actual}"}), 400
+
+            # 2. Reducir el stock del producto. La condición se evalúa en el mismo UPDATE, así dos pedidos
+            # simultáneos no pueden descontar a partir del mismo stock leído
+            cursor.execute("UPDATE productos SET stock = stock - ? WHERE id = ? AND stock >= ?", (cantidad, producto_id, cantidad))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                stock_actual = cursor.execute("SELECT stock FROM productos WHERE id = ?", (producto_id,)).fetchone()[0]
+                return jsonify({"error": f"Stock insuficiente para {nombre_producto}. Stock disponible: {stock_actual}"}), 400
+
+            # 3. Registrar el pedido. El id se calcula después del UPDATE, con el bloqueo de escritura de la
+            # cafetería ya tomado, y no escribe en el directorio: cada cafetería reparte sus propios ids
+            pedido_id = nuevo_id_pedido(conn, cafeteria_id)
+            cursor.execute("INSERT INTO pedidos (id, usuario_id, producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar, creado_en) VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))",
+                           (pedido_id, usuario_id, producto_id, 'pendiente', horario_retiro, cantidad, precio_unitario))
+            resultado = {"mensaje": "Pedido registrado y stock actualizado", "pedido_id": pedido_id, "cafeteria_id": cafeteria_id}
+            respuesta = a_json(resultado).decode('utf-8') # Se serializa una sola vez: es lo que se guarda y se repite
+
+            # 4. Registrar la clave en la misma transacción que el pedido
+            if clave:
+                creado_en = time.time()
+                cursor.execute("INSERT INTO claves_idempotencia (clave, usuario_id, pedido_id, respuesta, creado_en, huella) VALUES (?, ?, ?, ?, ?, ?)",
+                               (clave, usuario_id, resultado["pedido_id"], respuesta, creado_en, huella))
+
+            conn.commit()
+            if clave:
+                recordar_clave(clave, usuario_id, huella, respuesta, creado_en)
+            return respuesta_pedido(respuesta) # 201 Created
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            # Otra petición con la misma clave se registró al mismo tiempo: se devuelve su respuesta
+            previa = buscar_clave(cursor, clave, cafeteria_id) if clave else None
+            if previa:
+                return respuesta_repetida(previa, usuario_id, huella)
+            return jsonify({"error": f"Error al hacer el pedido: {str(e)}"}), 500
+        except Exception as e:
+            conn.rollback() # Revertir cualquier cambio si hay un error
+            return jsonify({"error": f"Error al hacer el pedido: {str(e)}"}), 500
 
 
 @app.route('/pedidos/<int:usuario_id>', methods=['GET'])
 def ver_pedidos_cliente(usuario_id):
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+    try:
+        desde, con_archivo = rango_historial()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    consulta = '''
         SELECT
             pedidos.id,
             productos.nombre,
@@ -210,41 +546,42 @@ def ver_pedidos_cliente(usuario_id):
             pedidos.estado,
             pedidos.horario_retiro,
             usuarios_cafeteria.nombre as nombre_cafeteria
-        FROM pedidos
+        FROM {pedidos} AS pedidos
         JOIN productos ON pedidos.producto_id = productos.id
-        JOIN usuarios AS usuarios_cafeteria ON productos.cafeteria_id = usuarios_cafeteria.id
-        WHERE pedidos.usuario_id = ?
-        ORDER BY pedidos.id DESC''', (usuario_id,))
-    pedidos = cursor.fetchall()
-    conn.close()
-
-    if not pedidos:
+        JOIN directorio.usuarios AS usuarios_cafeteria ON productos.cafeteria_id = usuarios_cafeteria.id
+        WHERE pedidos.usuario_id = ? AND (? IS NULL OR pedidos.creado_en >= ?)
+        ORDER BY pedidos.id DESC'''
+
+    def pedidos_en(cafeteria_id):
+        with conexion_cafeteria(cafeteria_id) as conn:
+            return list(lotes_pedidos(conn, consulta, (usuario_id, desde, desde), desde, con_archivo))
+
+    # Los pedidos del cliente pueden estar en cualquier cafetería: se consultan todas en paralelo
+    # y se intercalan por id, del más nuevo al más viejo
+    cuerpo, cantidad = serializar_filas(unir_por_id(en_cada_cafeteria(pedidos_en)),
+                                        ('id', 'producto', 'cantidad', 'precio_unitario', 'estado', 'horario_retiro', 'cafeteria'),
+                                        formato_compacto())
+
+    if not cantidad:
+        if not con_archivo:
+            return jsonify({"mensaje": f"No hay pedidos pendientes ni de los últimos {DIAS_ARCHIVO} días para este usuario. "
+                                       "Use ?historial=completo para ver también los archivados"}), 200
         return jsonify({"mensaje": "No hay pedidos para este usuario"}), 200 # No 404, solo informamos que no hay
 
-    return jsonify([{
-        'id': p[0],
-        'producto': p[1],
-        'cantidad': p[2],
-        'precio_unitario': p[3],
-        'estado': p[4],
-        'horario_retiro': p[5],
-        'cafeteria': p[6]
-    } for p in pedidos]), 200
+    return respuesta_json(cuerpo)
 
 # NUEVO ENDPOINT: Ver pedidos para una cafetería
 @app.route('/pedidos_cafeteria/<int:cafeteria_id>', methods=['GET'])
 def ver_pedidos_cafeteria(cafeteria_id):
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-
     # Verificar que el cafeteria_id existe y es de tipo 'cafeteria'
-    cursor.execute("SELECT tipo FROM usuarios WHERE id = ?", (cafeteria_id,))
-    user_type = cursor.fetchone()
-    if not user_type or user_type[0] != 'cafeteria':
-        conn.close()
+    if not es_cafeteria(cafeteria_id):
         return jsonify({"error": "ID de cafetería no válido o no autorizado"}), 403 # Forbidden
 
-    cursor.execute('''
+    try:
+        desde, con_archivo = rango_historial()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    consulta = '''
         SELECT
             pedidos.id,
             usuarios_cliente.nombre as nombre_cliente,
@@ -253,26 +590,23 @@ def ver_pedidos_cafeteria(cafeteria_id):
             pedidos.precio_unitario_al_comprar,
             pedidos.estado,
             pedidos.horario_retiro
-        FROM pedidos
+        FROM {pedidos} AS pedidos
         JOIN productos ON pedidos.producto_id = productos.id
-        JOIN usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
-        WHERE productos.cafeteria_id = ?
-        ORDER BY pedidos.id DESC''', (cafeteria_id,))
-    pedidos = cursor.fetchall()
-    conn.close()
-
-    if not pedidos:
+        JOIN directorio.usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
+        WHERE productos.cafeteria_id = ? AND (? IS NULL OR pedidos.creado_en >= ?)
+        ORDER BY pedidos.id DESC'''
+    with conexion_cafeteria(cafeteria_id) as conn:
+        cuerpo, cantidad = serializar_filas(lotes_pedidos(conn, consulta, (cafeteria_id, desde, desde), desde, con_archivo),
+                                            ('id', 'cliente', 'producto', 'cantidad', 'precio_unitario', 'estado', 'horario_retiro'),
+                                            formato_compacto())
+
+    if not cantidad:
+        if not con_archivo:
+            return jsonify({"mensaje": f"No hay pedidos pendientes ni de los últimos {DIAS_ARCHIVO} días para esta cafetería. "
+                                       "Use ?historial=completo para ver también los archivados"}), 200
         return jsonify({"mensaje": "No hay pedidos para esta cafetería"}), 200
 
-    return jsonify([{
-        'id': p[0],
-        'cliente': p[1],
-        'producto': p[2],
-        'cantidad': p[3],
-        'precio_unitario': p[4],
-        'estado': p[5],
-        'horario_retiro': p[6]
-    } for p in pedidos]), 200
+    return respuesta_json(cuerpo)
 
 
 @app.route('/pedido/<int:pedido_id>', methods=['PUT'])
@@ -288,36 +622,41 @@ def actualizar_estado_pedido(pedido_id): # Renombrado para mayor claridad
     if not cafeteria_id_solicitante:
         return jsonify({"error": "ID de cafetería solicitante es requerido"}), 400
 
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
     try:
-        # Verificar que el pedido existe y pertenece a la cafetería solicitante
-        cursor.execute('''
-            SELECT p.id
-            FROM pedidos p
-            JOIN productos pr ON p.producto_id = pr.id
-            WHERE p.id = ? AND pr.cafeteria_id = ?''', (pedido_id, cafeteria_id_solicitante))
-        pedido_existente = cursor.fetchone()
-
-        if not pedido_existente:
-            return jsonify({"error": "Pedido no encontrado o no autorizado para esta cafetería"}), 404 # Not Found o Forbidden
-
-        cursor.execute("UPDATE pedidos SET estado = ? WHERE id = ?", (estado, pedido_id))
-        conn.commit()
+        # Los pedidos se guardan en la base de su cafetería, así que solo se busca ahí
+        if not es_cafeteria(cafeteria_id_solicitante):
+            return jsonify({"error": "Pedido no encontrado o no autorizado para esta cafetería"}), 404
+
+        with conexion_cafeteria(cafeteria_id_solicitante) as conn:
+            cursor = conn.cursor()
+            # Verificar que el pedido existe y pertenece a la cafetería solicitante
+            cursor.execute('''
+                SELECT p.id
+                FROM pedidos p
+                JOIN productos pr ON p.producto_id = pr.id
+                WHERE p.id = ? AND pr.cafeteria_id = ?''', (pedido_id, cafeteria_id_solicitante))
+            pedido_existente = cursor.fetchone()
+
+            if not pedido_existente:
+                return jsonify({"error": "Pedido no encontrado o no autorizado para esta cafetería"}), 404 # Not Found o Forbidden
+
+            cursor.execute("UPDATE pedidos SET estado = ? WHERE id = ?", (estado, pedido_id))
+            conn.commit()
         return jsonify({"mensaje": "Estado del pedido actualizado"}), 200
     except Exception as e:
         return jsonify({"error": f"Error al actualizar pedido: {str(e)}"}), 500
-    finally:
-        conn.close()
 
 
 @app.route('/csv_pedidos/<int:usuario_id>', methods=['GET'])
 def generar_csv_cliente(usuario_id): # Renombrado para mayor claridad
-    conn = sqlite3.connect('cafeya.db')
     # Consulta más robusta para incluir nombre del producto y cafetería
-    cursor = conn.cursor()
-    cursor.execute('''
+    try:
+        desde, con_archivo = rango_historial(completo_por_defecto=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    consulta = '''
         SELECT
+            pedidos.id,
             usuarios_cliente.nombre as cliente,
             productos.nombre as producto,
             pedidos.cantidad_pedida,
@@ -325,19 +664,23 @@ def generar_csv_cliente(usuario_id): # Renombrado para mayor claridad
             pedidos.estado,
             pedidos.horario_retiro,
             usuarios_cafeteria.nombre as cafeteria
-        FROM pedidos
+        FROM {pedidos} AS pedidos
         JOIN productos ON pedidos.producto_id = productos.id
-        JOIN usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
-        JOIN usuarios AS usuarios_cafeteria ON productos.cafeteria_id = usuarios_cafeteria.id
-        WHERE pedidos.usuario_id = ?
-        ORDER BY pedidos.id DESC''', (usuario_id,))
-    data = cursor.fetchall()
-    conn.close()
+        JOIN directorio.usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
+        JOIN directorio.usuarios AS usuarios_cafeteria ON productos.cafeteria_id = usuarios_cafeteria.id
+        WHERE pedidos.usuario_id = ? AND (? IS NULL OR pedidos.creado_en >= ?)
+        ORDER BY pedidos.id DESC'''
+
+    def pedidos_en(cafeteria_id):
+        with conexion_cafeteria(cafeteria_id) as conn:
+            return list(lotes_pedidos(conn, consulta, (usuario_id, desde, desde), desde, con_archivo))
+
+    data = [fila for lote in unir_por_id(en_cada_cafeteria(pedidos_en)) for fila in lote]
 
     if not data:
         return jsonify({"mensaje": "No hay pedidos para este usuario"}), 200 # Cambiado a 200
 
-    df = pd.DataFrame(data, columns=["Cliente", "Producto", "Cantidad", "Precio Unitario", "Estado", "Horario Retiro", "Cafeteria"])
+    df = pd.DataFrame(data, columns=["Id", "Cliente", "Producto", "Cantidad", "Precio Unitario", "Estado", "Horario Retiro", "Cafeteria"]).drop(columns="Id")
     archivo = f"pedidos_cliente_{usuario_id}.csv"
     df.to_csv(archivo, index=False)
     return jsonify({"mensaje": "CSV generado", "archivo": archivo}), 200
@@ -345,18 +688,17 @@ def generar_csv_cliente(usuario_id): # Renombrado para mayor claridad
 # NUEVO ENDPOINT: Generar CSV de ventas para una cafetería
 @app.route('/csv_ventas_cafeteria/<int:cafeteria_id>', methods=['GET'])
 def generar_csv_cafeteria(cafeteria_id):
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-
     # Verificar que el cafeteria_id existe y es de tipo 'cafeteria'
-    cursor.execute("SELECT tipo FROM usuarios WHERE id = ?", (cafeteria_id,))
-    user_type = cursor.fetchone()
-    if not user_type or user_type[0] != 'cafeteria':
-        conn.close()
+    if not es_cafeteria(cafeteria_id):
         return jsonify({"error": "ID de cafetería no válido o no autorizado"}), 403
 
-    cursor.execute('''
+    try:
+        desde, con_archivo = rango_historial(completo_por_defecto=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    consulta = '''
         SELECT
+            pedidos.id,
             productos.nombre as producto,
             pedidos.cantidad_pedida,
             pedidos.precio_unitario_al_comprar,
@@ -364,18 +706,18 @@ def generar_csv_cafeteria(cafeteria_id):
             pedidos.estado,
             pedidos.horario_retiro,
             usuarios_cliente.nombre as cliente
-        FROM pedidos
+        FROM {pedidos} AS pedidos
         JOIN productos ON pedidos.producto_id = productos.id
-        JOIN usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
-        WHERE productos.cafeteria_id = ?
-        ORDER BY pedidos.id DESC''', (cafeteria_id,))
-    data = cursor.fetchall()
-    conn.close()
+        JOIN directorio.usuarios AS usuarios_cliente ON pedidos.usuario_id = usuarios_cliente.id
+        WHERE productos.cafeteria_id = ? AND (? IS NULL OR pedidos.creado_en >= ?)
+        ORDER BY pedidos.id DESC'''
+    with conexion_cafeteria(cafeteria_id) as conn:
+        data = [fila for lote in lotes_pedidos(conn, consulta, (cafeteria_id, desde, desde), desde, con_archivo) for fila in lote]
 
     if not data:
         return jsonify({"mensaje": "No hay ventas registradas para esta cafetería"}), 200
 
-    df = pd.DataFrame(data, columns=["Producto", "Cantidad Vendida", "Precio Unitario", "Precio Total", "Estado Pedido", "Horario Retiro", "Cliente"])
+    df = pd.DataFrame(data, columns=["Id", "Producto", "Cantidad Vendida", "Precio Unitario", "Precio Total", "Estado Pedido", "Horario Retiro", "Cliente"]).drop(columns="Id")
     archivo = f"ventas_cafeteria_{cafeteria_id}.csv"
     df.to_csv(archivo, index=False)
     return jsonify({"mensaje": "CSV de ventas generado", "archivo": archivo}), 200
@@ -383,30 +725,32 @@ def generar_csv_cafeteria(cafeteria_id):
 
 @app.route('/grafico_pedidos/<int:cafeteria_id>', methods=['GET'])
 def grafico_pedidos_cafeteria(cafeteria_id): # Renombrado para mayor claridad
-    conn = sqlite3.connect('cafeya.db')
-    cursor = conn.cursor()
-
     # Verificar que el cafeteria_id existe y es de tipo 'cafeteria'
-    cursor.execute("SELECT tipo FROM usuarios WHERE id = ?", (cafeteria_id,))
-    user_type = cursor.fetchone()
-    if not user_type or user_type[0] != 'cafeteria':
-        conn.close()
+    if not es_cafeteria(cafeteria_id):
         return jsonify({"error": "ID de cafetería no válido o no autorizado"}), 403
 
+    try:
+        desde, con_archivo = rango_historial(completo_por_defecto=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     query = '''
         SELECT pr.nombre, SUM(p.cantidad_pedida) AS cantidad_total_pedida
-        FROM pedidos p
+        FROM {pedidos} p
         JOIN productos pr ON p.producto_id = pr.id
-        WHERE pr.cafeteria_id = ?
+        WHERE pr.cafeteria_id = ? AND (? IS NULL OR p.creado_en >= ?)
         GROUP BY pr.nombre
-        ORDER BY cantidad_total_pedida DESC
     '''
-    df = pd.read_sql_query(query, conn, params=(cafeteria_id,))
-    conn.close()
+    with conexion_cafeteria(cafeteria_id) as conn:
+        filas = [fila for lote in lotes_pedidos(conn, query, (cafeteria_id, desde, desde), desde, con_archivo, por_id=False) for fila in lote]
 
-    if df.empty:
+    if not filas:
         return jsonify({"mensaje": "No hay pedidos para generar el gráfico"}), 200 # Cambiado a 200
 
+    # Se suman los totales parciales de la tabla activa y de los archivos
+    df = (pd.DataFrame(filas, columns=['nombre', 'cantidad_total_pedida'])
+          .groupby('nombre', as_index=False)['cantidad_total_pedida'].sum()
+          .sort_values('cantidad_total_pedida', ascending=False))
+
     plt.figure(figsize=(10, 6))
     plt.barh(df['nombre'], df['cantidad_total_pedida'], color='skyblue')
     plt.xlabel("Cantidad Total Pedida")
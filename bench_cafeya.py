@@ -0,0 +1,218 @@
+"""Mediciones de rendimiento de la API CaféYa.
+
+Uso: python bench_cafeya.py [medicion ...]    (sin argumentos corre todas)
+
+Cada corrida crea sus bases en una carpeta temporal, así nunca toca cafeya.db ni los datos reales.
+Las rutas se llaman con app.test_client(), sin levantar el servidor.
+"""
+import atexit
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, RAIZ)
+# Los procesos de medir_shards vuelven a importar este módulo: usan la carpeta del proceso principal
+CARPETA = os.environ.get('CAFEYA_BENCH_CARPETA')
+if CARPETA is None:
+    CARPETA = os.environ['CAFEYA_BENCH_CARPETA'] = tempfile.mkdtemp(prefix='bench_cafeya_')
+    atexit.register(shutil.rmtree, CARPETA, ignore_errors=True)
+os.chdir(CARPETA)
+
+import app_cafeya # Se importa después del chdir: crea sus bases en la carpeta temporal
+import almacen_cafeya
+from flask import jsonify
+
+cliente = app_cafeya.app.test_client()
+
+def medir(funcion, repeticiones=5):
+    """Devuelve (mejor tiempo en ms, pico de memoria asignada en KB) de llamar a funcion()."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    tracemalloc.start()
+    funcion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(tiempos) * 1000, pico / 1024
+
+def imprimir(nombre, tiempo_ms, memoria_kb):
+    print(f"  {nombre:<62} {tiempo_ms:9.1f} ms {memoria_kb:10.0f} KB")
+
+def nuevo_usuario(nombre, tipo):
+    return cliente.post('/registrar_usuario', json={"nombre": nombre, "tipo": tipo}).get_json()["usuario_id"]
+
+def cargar_productos(cafeteria_id, cantidad, stock=10 ** 6):
+    """Carga productos directo en la base de la cafetería (más rápido que un POST por producto)."""
+    ids = [app_cafeya.registrar_producto(cafeteria_id) for _ in range(cantidad)]
+    with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+        conn.executemany("INSERT INTO productos (id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [(i, f"Producto {i}", 1500.0, stock, '08:00-18:00', cafeteria_id, 'Bebida') for i in ids])
+        conn.commit()
+    return ids
+
+def ids_pedidos(cafeteria_id, cantidad):
+    """Devuelve `cantidad` ids de pedido seguidos de la cafetería, como los daría nuevo_id_pedido uno por uno."""
+    with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+        primero = app_cafeya.nuevo_id_pedido(conn, cafeteria_id)
+    paso = 1 << almacen_cafeya.BITS_CAFETERIA
+    return range(primero, primero + cantidad * paso, paso)
+
+# -------------------------- Serialización ---------------------------
+def serializacion_antes(cafeteria_id, consulta, parametros, claves):
+    """Como era antes: fetchall(), una lista de dicts y jsonify."""
+    with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+        filas = conn.execute(consulta, parametros).fetchall()
+    with app_cafeya.app.test_request_context():
+        return jsonify([dict(zip(claves, fila)) for fila in filas]).get_data()
+
+def serializacion_ahora(cafeteria_id, consulta, parametros, claves, compacto):
+    with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+        return app_cafeya.serializar_filas(app_cafeya.lotes_cursor(conn.execute(consulta, parametros)), claves, compacto)[0]
+
+def medir_serializacion(productos=20000, pedidos=50000):
+    print(f"\nSerialización: {productos} productos, {pedidos} pedidos de un cliente "
+          f"(orjson {'instalado' if app_cafeya.orjson else 'no instalado'})")
+    cafeteria_id = nuevo_usuario('bench_cafeteria_serializacion', 'cafeteria')
+    usuario_id = nuevo_usuario('bench_cliente_serializacion', 'cliente')
+    ids = cargar_productos(cafeteria_id, productos)
+    with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+        conn.executemany("INSERT INTO pedidos (id, usuario_id, producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar) VALUES (?, ?, ?, 'pendiente', '10:30', 1, 1500.0)",
+                         [(pedido_id, usuario_id, ids[i % len(ids)]) for i, pedido_id in enumerate(ids_pedidos(cafeteria_id, pedidos))])
+        conn.commit()
+
+    casos = [
+        ('productos', "SELECT id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria FROM productos WHERE stock > 0", (),
+         ('id', 'nombre', 'precio', 'stock', 'horario_retiro', 'cafeteria_id', 'categoria')),
+        ('pedidos de un cliente', '''SELECT pedidos.id, productos.nombre, pedidos.cantidad_pedida, pedidos.precio_unitario_al_comprar,
+                                            pedidos.estado, pedidos.horario_retiro, usuarios_cafeteria.nombre
+                                     FROM pedidos JOIN productos ON pedidos.producto_id = productos.id
+                                     JOIN directorio.usuarios AS usuarios_cafeteria ON productos.cafeteria_id = usuarios_cafeteria.id
+                                     WHERE pedidos.usuario_id = ? ORDER BY pedidos.id DESC''', (usuario_id,),
+         ('id', 'producto', 'cantidad', 'precio_unitario', 'estado', 'horario_retiro', 'cafeteria')),
+    ]
+    for nombre, consulta, parametros, claves in casos:
+        imprimir(f"{nombre}: fetchall + dicts + jsonify (antes)", *medir(lambda: serializacion_antes(cafeteria_id, consulta, parametros, claves)))
+        imprimir(f"{nombre}: por lotes, dicts", *medir(lambda: serializacion_ahora(cafeteria_id, consulta, parametros, claves, False)))
+        imprimir(f"{nombre}: por lotes, compacto", *medir(lambda: serializacion_ahora(cafeteria_id, consulta, parametros, claves, True)))
+
+    print("  Rutas completas (test_client):")
+    for ruta in ('/productos', '/productos?formato=compacto', f'/pedidos/{usuario_id}', f'/pedidos/{usuario_id}?formato=compacto',
+                 f'/pedidos_cafeteria/{cafeteria_id}'):
+        imprimir(f"GET {ruta}", *medir(lambda: cliente.get(ruta)))
+
+# --------------------------- Archivado ------------------------------
+TOTAL_PEDIDOS = int(os.environ.get('CAFEYA_BENCH_PEDIDOS', 5_000_000))
+
+def cargar_historial(cafeterias, clientes, total, dias=730):
+    """Reparte `total` pedidos entre las cafeterías, con fechas de los últimos `dias` días y 3% pendientes.
+
+    Las fechas se ordenan de la más vieja a la más nueva, así el id crece con la fecha como en la API.
+    """
+    por_cafeteria = total // len(cafeterias)
+    azar = random.Random(0)
+    for cafeteria_id in cafeterias:
+        productos = cargar_productos(cafeteria_id, 20)
+        minutos = sorted((azar.randrange(dias * 24 * 60) for _ in range(por_cafeteria)), reverse=True)
+        filas = ((pedido_id, azar.choice(clientes), azar.choice(productos),
+                  'pendiente' if azar.random() < 0.03 else azar.choice(('completado', 'cancelado')),
+                  '10:30', 1, 1500.0, f"-{hace} minutes")
+                 for pedido_id, hace in zip(ids_pedidos(cafeteria_id, por_cafeteria), minutos))
+        with app_cafeya.conexion_cafeteria(cafeteria_id) as conn:
+            conn.executemany("INSERT INTO pedidos (id, usuario_id, producto_id, estado, horario_retiro, cantidad_pedida, precio_unitario_al_comprar, creado_en) VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now', ?))", filas)
+            conn.commit()
+
+def medir_archivo(total=TOTAL_PEDIDOS, cantidad_cafeterias=50, cantidad_clientes=1000):
+    print(f"\nArchivado: {total} pedidos en {cantidad_cafeterias} cafeterías, {cantidad_clientes} clientes, "
+          f"fechas de los últimos 2 años, archivado a {app_cafeya.DIAS_ARCHIVO} días")
+    cafeterias = [nuevo_usuario(f'bench_cafeteria_archivo_{i}', 'cafeteria') for i in range(cantidad_cafeterias)]
+    with app_cafeya.conexion_directorio() as conn:
+        primero = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM usuarios").fetchone()[0]
+        conn.executemany("INSERT INTO usuarios (id, nombre, tipo) VALUES (?, ?, 'cliente')",
+                         [(primero + i, f'bench_cliente_archivo_{i}') for i in range(cantidad_clientes)])
+        conn.commit()
+    clientes = list(range(primero, primero + cantidad_clientes))
+
+    inicio = time.perf_counter()
+    cargar_historial(cafeterias, clientes, total)
+    print(f"  Carga de datos: {time.perf_counter() - inicio:.1f} s")
+
+    # Antes y después de archivar cada ruta tiene que devolver las mismas filas: con desde posterior al
+    # corte del archivado (lo reciente) o con historial=completo (todo, incluidos los archivos)
+    desde = (datetime.now(timezone.utc).date() - timedelta(days=app_cafeya.DIAS_ARCHIVO - 1)).isoformat()
+    rutas = [(f'historial de un cliente desde {desde}', f'/pedidos/{clientes[0]}?desde={desde}'),
+             (f'pedidos de una cafetería desde {desde}', f'/pedidos_cafeteria/{cafeterias[0]}?desde={desde}'),
+             ('historial de un cliente, completo', f'/pedidos/{clientes[0]}?historial=completo'),
+             ('pedidos de una cafetería, completo', f'/pedidos_cafeteria/{cafeterias[0]}?historial=completo')]
+
+    def medir_rutas(momento):
+        for nombre, ruta in rutas:
+            filas = len(cliente.get(ruta).get_json())
+            imprimir(f"{momento}: {nombre} ({filas} filas)", *medir(lambda: cliente.get(ruta), repeticiones=3))
+
+    medir_rutas('antes')
+    inicio = time.perf_counter()
+    movidos = app_cafeya.archivar_pedidos()
+    print(f"  Archivado de {movidos} pedidos: {time.perf_counter() - inicio:.1f} s")
+    medir_rutas('después')
+
+# -------------------- Una base por cafetería ------------------------
+def proceso_pedidos(productos, usuario_id, cantidad, largada, resultados):
+    """Hace `cantidad` pedidos con su propio test_client y manda los códigos de respuesta a `resultados`."""
+    cliente_proceso = app_cafeya.app.test_client()
+    largada.wait() # Todos los procesos arrancan juntos, después de importar la app
+    codigos = [cliente_proceso.post('/pedido', json={"usuario_id": usuario_id, "producto_id": productos[i % len(productos)],
+                                                     "horario_retiro": "10:30"}).status_code
+               for i in range(cantidad)]
+    resultados.put(codigos)
+
+def pedir_en_paralelo(productos_por_proceso, usuario_id, pedidos_por_proceso):
+    """Lanza un proceso por lista de productos. Devuelve (segundos, códigos de respuesta).
+
+    Son procesos y no hilos: con hilos el GIL limita antes que el bloqueo de escritura de SQLite.
+    """
+    contexto = multiprocessing.get_context('spawn')
+    largada = contexto.Barrier(len(productos_por_proceso) + 1)
+    resultados = contexto.Queue()
+    procesos = [contexto.Process(target=proceso_pedidos, args=(productos, usuario_id, pedidos_por_proceso, largada, resultados))
+                for productos in productos_por_proceso]
+    for proceso in procesos:
+        proceso.start()
+    largada.wait()
+    inicio = time.perf_counter()
+    codigos = [codigo for _ in procesos for codigo in resultados.get()]
+    segundos = time.perf_counter() - inicio
+    for proceso in procesos:
+        proceso.join()
+    return segundos, codigos
+
+def medir_shards(total=1800, cantidad_procesos=9):
+    print(f"\nEscrituras concurrentes: {total} pedidos POST /pedido repartidos en {cantidad_procesos} procesos")
+    usuario_id = nuevo_usuario('bench_cliente_shards', 'cliente')
+    cafeterias = [nuevo_usuario(f'bench_cafeteria_shards_{i}', 'cafeteria') for i in range(cantidad_procesos)]
+    productos = [cargar_productos(cafeteria_id, 10) for cafeteria_id in cafeterias]
+
+    casos = [('todos los procesos en la misma cafetería', [productos[0]] * cantidad_procesos),
+             ('cada proceso en su propia cafetería', productos)]
+    for nombre, productos_por_proceso in casos:
+        segundos, codigos = pedir_en_paralelo(productos_por_proceso, usuario_id, total // cantidad_procesos)
+        errores = sum(codigo != 201 for codigo in codigos)
+        print(f"  {nombre:<62} {segundos:9.2f} s {len(codigos) / segundos:8.0f} pedidos/s  errores: {errores}")
+
+MEDICIONES = {
+    'serializacion': medir_serializacion,
+    'archivo': medir_archivo,
+    'shards': medir_shards,
+}
+
+if __name__ == '__main__':
+    for nombre in sys.argv[1:] or MEDICIONES:
+        MEDICIONES[nombre]()
@@ -1,7 +1,16 @@
 import requests
 import pandas as pd
+import json
+import sqlite3
+import threading
+import time
+import uuid
 
 BASE_URL = "http://127.0.0.1:5000"  # Asegúrate de que esta URL coincida con la de tu Flask app
+CACHE_DB = "cache_cafeya.db"  # Caché local: el menú arranca con los últimos datos conocidos
+CACHE_TTL = 30  # Segundos durante los cuales se usa la caché sin consultar al servidor
+TIMEOUT = 5  # Segundos máximos de espera por una respuesta del servidor
+ERRORES_CONEXION = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
 
 usuario_actual = {
     "id": None,
@@ -18,6 +27,149 @@ def mostrar_respuesta(response):
         print("⚠️ La respuesta no es JSON:")
         print(response.text)
 
+# --------------------------- Caché local ----------------------------
+def crear_cache_local():
+    """Crea las tablas de la caché local si no existen."""
+    conn = sqlite3.connect(CACHE_DB)
+    cursor = conn.cursor()
+    # Respuestas GET cacheadas: ruta, ETag del servidor, cuerpo JSON y momento en que se guardó
+    cursor.execute('''CREATE TABLE IF NOT EXISTS respuestas (
+        ruta TEXT PRIMARY KEY,
+        etag TEXT,
+        cuerpo TEXT NOT NULL,
+        guardado_en REAL NOT NULL
+    )''')
+    # Pedidos hechos sin conexión, a reenviar con la misma clave de idempotencia
+    cursor.execute('''CREATE TABLE IF NOT EXISTS pedidos_pendientes (
+        clave TEXT PRIMARY KEY,
+        usuario_id INTEGER NOT NULL, -- Solo se reenvían los pedidos del usuario que los hizo
+        datos TEXT NOT NULL,
+        creado_en REAL NOT NULL
+    )''')
+    # Cachés creadas antes de agregar usuario_id: se agrega la columna tomándola de los datos del pedido
+    cursor.execute("PRAGMA table_info(pedidos_pendientes)")
+    if 'usuario_id' not in [columna[1] for columna in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE pedidos_pendientes ADD COLUMN usuario_id INTEGER")
+        for clave, datos in cursor.execute("SELECT clave, datos FROM pedidos_pendientes").fetchall():
+            cursor.execute("UPDATE pedidos_pendientes SET usuario_id = ? WHERE clave = ?", (json.loads(datos)["usuario_id"], clave))
+    conn.commit()
+    conn.close()
+
+crear_cache_local()
+
+_cache_lock = threading.Lock()
+_en_vuelo = {}  # ruta -> petición en curso, para no repetir GETs idénticos simultáneos
+
+def _leer_cache(ruta):
+    conn = sqlite3.connect(CACHE_DB)
+    fila = conn.execute("SELECT etag, cuerpo, guardado_en FROM respuestas WHERE ruta = ?", (ruta,)).fetchone()
+    conn.close()
+    return fila
+
+def _guardar_cache(ruta, etag, cuerpo):
+    conn = sqlite3.connect(CACHE_DB)
+    conn.execute("INSERT OR REPLACE INTO respuestas (ruta, etag, cuerpo, guardado_en) VALUES (?, ?, ?, ?)",
+                 (ruta, etag, cuerpo, time.time()))
+    conn.commit()
+    conn.close()
+
+def invalidar_cache(*rutas):
+    """Descarta las respuestas cacheadas de las rutas indicadas, con o sin parámetros (ej. ?historial=completo)."""
+    conn = sqlite3.connect(CACHE_DB)
+    conn.executemany("DELETE FROM respuestas WHERE ruta = ? OR ruta LIKE ?", [(ruta, ruta + "?%") for ruta in rutas])
+    conn.commit()
+    conn.close()
+
+def _coalescer(clave, funcion):
+    """Si ya hay una petición idéntica en curso, espera su resultado en lugar de repetirla."""
+    with _cache_lock:
+        llamada = _en_vuelo.get(clave)
+        lider = llamada is None
+        if lider:
+            llamada = _en_vuelo[clave] = {"listo": threading.Event(), "resultado": None, "error": None}
+    if lider:
+        try:
+            llamada["resultado"] = funcion()
+        except Exception as e:
+            llamada["error"] = e
+        finally:
+            with _cache_lock:
+                del _en_vuelo[clave]
+            llamada["listo"].set()
+    else:
+        llamada["listo"].wait()
+    if llamada["error"] is not None:
+        raise llamada["error"]
+    return llamada["resultado"]
+
+def _revalidar(ruta, fila):
+    """Consulta al servidor enviando el ETag guardado; un 304 confirma que la caché sigue vigente."""
+    headers = {"If-None-Match": fila[0]} if fila and fila[0] else {}
+    try:
+        response = requests.get(f"{BASE_URL}{ruta}", headers=headers, timeout=TIMEOUT)
+    except ERRORES_CONEXION:
+        if fila:
+            print("📴 Sin conexión con el servidor: se muestran los últimos datos guardados.")
+            return 200, json.loads(fila[1])
+        raise
+
+    if response.status_code == 304 and fila:
+        _guardar_cache(ruta, fila[0], fila[1])
+        return 200, json.loads(fila[1])
+    if response.status_code == 200:
+        _guardar_cache(ruta, response.headers.get("ETag"), response.text)
+        return 200, response.json()
+    try:
+        return response.status_code, response.json()
+    except ValueError:
+        return response.status_code, response.text
+
+def get_con_cache(ruta):
+    """Hace un GET a la API pasando por la caché local. Devuelve (código de estado, datos)."""
+    fila = _leer_cache(ruta)
+    if fila and time.time() - fila[2] < CACHE_TTL:
+        return 200, json.loads(fila[1])
+    return _coalescer(ruta, lambda: _revalidar(ruta, fila))
+
+def mostrar_error(codigo, datos):
+    """Muestra el código de estado y los datos de una respuesta no exitosa."""
+    print(f"\nCódigo de estado: {codigo}")
+    print(datos)
+
+def encolar_pedido(clave, data):
+    """Guarda un pedido que no se pudo enviar para reenviarlo más tarde."""
+    conn = sqlite3.connect(CACHE_DB)
+    conn.execute("INSERT OR IGNORE INTO pedidos_pendientes (clave, usuario_id, datos, creado_en) VALUES (?, ?, ?, ?)",
+                 (clave, data["usuario_id"], json.dumps(data), time.time()))
+    conn.commit()
+    conn.close()
+
+def reenviar_pedidos_pendientes():
+    """Reenvía los pedidos del usuario actual que quedaron en cola mientras el servidor no respondía."""
+    conn = sqlite3.connect(CACHE_DB)
+    pendientes = conn.execute("SELECT clave, datos FROM pedidos_pendientes WHERE usuario_id = ? ORDER BY creado_en",
+                              (usuario_actual["id"],)).fetchall()
+    conn.close()
+
+    for clave, datos in pendientes:
+        data = json.loads(datos)
+        try:
+            response = requests.post(f"{BASE_URL}/pedido", json=data,
+                                     headers={"Idempotency-Key": clave}, timeout=TIMEOUT)
+        except ERRORES_CONEXION:
+            return  # Sigue sin conexión, se reintenta la próxima vez
+        if response.status_code >= 500:
+            return  # Error del servidor: el pedido queda en cola
+
+        print("\n📤 Pedido en cola reenviado:")
+        mostrar_respuesta(response)
+        if response.status_code == 201:
+            invalidar_cache("/productos", f"/pedidos/{data['usuario_id']}")
+        conn = sqlite3.connect(CACHE_DB)
+        conn.execute("DELETE FROM pedidos_pendientes WHERE clave = ?", (clave,))
+        conn.commit()
+        conn.close()
+
 def registrar_usuario():
     """Registra un nuevo usuario."""
     nombre = input("Nombre de usuario: ")
@@ -66,9 +218,8 @@ def login_usuario():
 def listar_productos():
     """Lista todos los productos disponibles."""
     try:
-        response = requests.get(f"{BASE_URL}/productos")
-        if response.status_code == 200:
-            productos = response.json()
+        codigo, productos = get_con_cache("/productos")
+        if codigo == 200:
             if productos:
                 df = pd.DataFrame(productos)
                 print("\n☕ Productos disponibles:")
@@ -76,12 +227,13 @@ def listar_productos():
             else:
                 print("⚠️ No hay productos disponibles en este momento.")
         else:
-            mostrar_respuesta(response)
-    except requests.exceptions.ConnectionError:
+            mostrar_error(codigo, productos)
+    except ERRORES_CONEXION:
         print("❌ Error de conexión con el servidor.")
 
 def hacer_pedido():
     """Permite al cliente realizar un pedido."""
+    reenviar_pedidos_pendientes()
     listar_productos()
     producto_id = input("ID del producto a pedir: ")
     horario_retiro = input("Horario de retiro (ej. '10:30'): ")
@@ -90,27 +242,41 @@ def hacer_pedido():
         "producto_id": int(producto_id),
         "horario_retiro": horario_retiro
     }
+    clave = uuid.uuid4().hex  # Clave de idempotencia: el mismo pedido reenviado no se duplica
     try:
-        response = requests.post(f"{BASE_URL}/pedido", json=data)
+        response = requests.post(f"{BASE_URL}/pedido", json=data,
+                                 headers={"Idempotency-Key": clave}, timeout=TIMEOUT)
         mostrar_respuesta(response)
+        if response.status_code == 201:
+            invalidar_cache("/productos", f"/pedidos/{usuario_actual['id']}")
     except requests.exceptions.ConnectionError:
-        print("❌ Error de conexión con el servidor.")
+        # No llegó al servidor: se puede reenviar más tarde con la misma clave
+        encolar_pedido(clave, data)
+        print("📴 Sin conexión con el servidor. El pedido quedó en cola y se enviará cuando vuelva la conexión.")
+    except requests.exceptions.Timeout:
+        # El servidor pudo haberlo registrado: no se encola, se avisa para que el cliente lo verifique
+        invalidar_cache(f"/pedidos/{usuario_actual['id']}")
+        print("⏱️ El servidor no respondió a tiempo. Revisa 'Ver mis pedidos' antes de volver a pedir.")
 
 def ver_pedidos_cliente():
     """Muestra los pedidos del cliente actual."""
+    # Por defecto el servidor devuelve los pedidos recientes y los pendientes; los más viejos están archivados
+    completo = input("¿Incluir pedidos antiguos (archivados)? (s/n): ").lower() == 's'
+    ruta = f"/pedidos/{usuario_actual['id']}" + ("?historial=completo" if completo else "")
     try:
-        response = requests.get(f"{BASE_URL}/pedidos/{usuario_actual['id']}")
-        if response.status_code == 200:
-            pedidos = response.json()
-            if pedidos:
+        codigo, pedidos = get_con_cache(ruta)
+        if codigo == 200:
+            if isinstance(pedidos, dict) and "mensaje" in pedidos:
+                print(f"⚠️ {pedidos['mensaje']}")
+            elif pedidos:
                 df = pd.DataFrame(pedidos)
                 print(f"\n📋 Tus Pedidos ({usuario_actual['nombre']}):")
                 print(df.to_string(index=False))
             else:
                 print("⚠️ No tienes pedidos registrados.")
         else:
-            mostrar_respuesta(response)
-    except requests.exceptions.ConnectionError:
+            mostrar_error(codigo, pedidos)
+    except ERRORES_CONEXION:
         print("❌ Error de conexión con el servidor.")
 
 def generar_csv_pedidos_cliente():
@@ -216,6 +382,7 @@ def generar_grafico_pedidos_cafeteria():
 # Menús por tipo de usuario
 def menu_cliente():
     """Menú para usuarios tipo cliente."""
+    reenviar_pedidos_pendientes()
     while True:
         print(f"\n☕ Menú del Cliente ({usuario_actual['nombre']})")
         print("1. Listar productos")
@@ -0,0 +1,110 @@
+"""Migra la base única cafeya.db al esquema con un directorio global y una base por cafetería.
+
+Uso: python migrar_cafeya.py [ruta_de_cafeya.db]
+
+La base original no se modifica. Los pedidos que estaban en los archivos mensuales vuelven a la
+base de su cafetería y el archivado en segundo plano los vuelve a archivar por cafetería.
+
+Todo se arma en una carpeta temporal y se mueve a su lugar recién cuando todas las cafeterías
+quedaron confirmadas. El directorio se mueve último: si existe, la migración terminó.
+"""
+import sqlite3
+import os
+import shutil
+import sys
+import tempfile
+from almacen_cafeya import DIRECTORIO_DB, CARPETA_CAFETERIAS, crear_directorio, crear_base_cafeteria, ruta_cafeteria
+
+COLUMNAS_PEDIDOS = 'p.id, p.usuario_id, p.producto_id, p.estado, p.horario_retiro, p.cantidad_pedida, p.precio_unitario_al_comprar'
+
+def tiene_tabla(conn, tabla):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabla,)).fetchone() is not None
+
+def copiar_pedidos(vieja, destino, tabla, cafeteria_id):
+    """Copia a la base de la cafetería los pedidos de `tabla` cuyos productos le pertenecen."""
+    esquema = tabla.split('.')[0]
+    columnas = [fila[1] for fila in vieja.execute(f"PRAGMA {esquema}.table_info(pedidos)")]
+    # Bases anteriores a la columna creado_en: se toma la fecha de la migración
+    creado_en = 'p.creado_en' if 'creado_en' in columnas else "datetime('now')"
+    cursor = vieja.execute(f'''
+        SELECT {COLUMNAS_PEDIDOS}, {creado_en}
+        FROM {tabla} p
+        JOIN main.productos pr ON p.producto_id = pr.id
+        WHERE pr.cafeteria_id = ?''', (cafeteria_id,))
+    destino.executemany('''INSERT OR IGNORE INTO pedidos (id, usuario_id, producto_id, estado, horario_retiro,
+                           cantidad_pedida, precio_unitario_al_comprar, creado_en) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', cursor)
+
+def migrar(origen='cafeya.db'):
+    """Migra origen al esquema por cafetería. Devuelve True si terminó y False si no se pudo empezar."""
+    if os.path.exists(DIRECTORIO_DB):
+        print(f"⚠️ {DIRECTORIO_DB} ya existe. Bórrelo (junto con la carpeta de cafeterías) para volver a migrar.")
+        return False
+    if os.path.exists(CARPETA_CAFETERIAS):
+        print(f"⚠️ La carpeta {CARPETA_CAFETERIAS} ya existe pero no hay directorio: quedó de una migración incompleta. Bórrela para volver a migrar.")
+        return False
+
+    # Misma carpeta que el destino, así los os.rename del final no cruzan de disco
+    temporal = tempfile.mkdtemp(prefix='migracion_cafeya_', dir=os.path.dirname(os.path.abspath(DIRECTORIO_DB)))
+    try:
+        migrar_a(origen, temporal)
+        os.rename(os.path.join(temporal, CARPETA_CAFETERIAS), CARPETA_CAFETERIAS)
+        os.rename(os.path.join(temporal, os.path.basename(DIRECTORIO_DB)), DIRECTORIO_DB)
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+    print(f"✅ Migración terminada. Directorio global: {DIRECTORIO_DB}")
+    return True
+
+def migrar_a(origen, temporal):
+    """Arma el directorio y las bases de cada cafetería dentro de la carpeta temporal."""
+    vieja = sqlite3.connect(origen)
+    directorio = sqlite3.connect(os.path.join(temporal, os.path.basename(DIRECTORIO_DB)))
+    try:
+        crear_directorio(directorio)
+
+        # 1. Usuarios y ruteo de productos al directorio global (se conservan los ids)
+        directorio.executemany("INSERT INTO usuarios (id, nombre, tipo) VALUES (?, ?, ?)",
+                               vieja.execute("SELECT id, nombre, tipo FROM usuarios"))
+        directorio.executemany("INSERT INTO productos_directorio (id, cafeteria_id) VALUES (?, ?)",
+                               vieja.execute('''SELECT pr.id, pr.cafeteria_id FROM productos pr
+                                                JOIN usuarios u ON pr.cafeteria_id = u.id AND u.tipo = 'cafeteria' '''))
+        directorio.commit()
+        cafeterias = [fila[0] for fila in directorio.execute("SELECT id FROM usuarios WHERE tipo = 'cafeteria' ORDER BY id")]
+
+        archivos = []
+        if tiene_tabla(vieja, 'archivos_pedidos'):
+            archivos = [fila[0] for fila in vieja.execute("SELECT archivo FROM archivos_pedidos") if os.path.exists(fila[0])]
+
+        # 2. Productos, pedidos (activos y archivados) y claves de idempotencia a la base de cada cafetería
+        os.makedirs(os.path.join(temporal, CARPETA_CAFETERIAS))
+        for cafeteria_id in cafeterias:
+            destino = sqlite3.connect(os.path.join(temporal, ruta_cafeteria(cafeteria_id)))
+            crear_base_cafeteria(destino)
+
+            destino.executemany("INSERT INTO productos (id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                vieja.execute("SELECT id, nombre, precio, stock, horario_retiro, cafeteria_id, categoria FROM productos WHERE cafeteria_id = ?",
+                                              (cafeteria_id,)))
+            copiar_pedidos(vieja, destino, 'main.pedidos', cafeteria_id)
+            for archivo in archivos:
+                vieja.execute("ATTACH DATABASE ? AS archivo", (archivo,))
+                try:
+                    copiar_pedidos(vieja, destino, 'archivo.pedidos', cafeteria_id)
+                finally:
+                    vieja.execute("DETACH DATABASE archivo")
+
+            if tiene_tabla(vieja, 'claves_idempotencia'):
+                destino.executemany("INSERT OR IGNORE INTO claves_idempotencia (clave, usuario_id, pedido_id, respuesta, creado_en) VALUES (?, ?, ?, ?, ?)",
+                                    vieja.execute('''SELECT c.clave, c.usuario_id, c.pedido_id, c.respuesta, c.creado_en
+                                                     FROM claves_idempotencia c
+                                                     JOIN pedidos p ON c.pedido_id = p.id
+                                                     JOIN productos pr ON p.producto_id = pr.id
+                                                     WHERE pr.cafeteria_id = ?''', (cafeteria_id,)))
+            destino.commit()
+            cantidad = destino.execute("SELECT COUNT(*) FROM pedidos").fetchone()[0]
+            destino.close()
+            print(f"✅ Cafetería {cafeteria_id}: {cantidad} pedidos migrados a {ruta_cafeteria(cafeteria_id)}")
+    finally:
+        directorio.close()
+        vieja.close()
+
+if __name__ == '__main__':
+    migrar(sys.argv[1] if len(sys.argv) > 1 else 'cafeya.db')